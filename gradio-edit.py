@@ -1,21 +1,38 @@
 import os
 import gradio as gr
-from google import genai
-from google.genai import errors
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError
 from io import BytesIO
 import tempfile
 import atexit # Import atexit for robust cleanup
+import threading
+import zipfile
+import mimetypes
+import hashlib
+import re
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
-# --- Global list to track temporary files ---
-# This list will hold the paths of all generated files for this session.
-temp_files_to_clean = []
+# --- Global set to track temporary files ---
+# This set holds the paths of all generated files for this process; a set
+# dedups repeated paths, and the lock keeps it consistent when several
+# requests run concurrently. Files are also grouped by Gradio session so
+# they can be removed as soon as that browser session ends.
+temp_files_to_clean = set()
+session_temp_files = {}
+temp_files_lock = threading.Lock()
 
-# --- Function to perform cleanup ---
-def cleanup_temp_files():
-    """Iterates through the global list and deletes the tracked files."""
-    print(f"Cleaning up {len(temp_files_to_clean)} temporary files...")
-    for file_path in temp_files_to_clean:
+def track_temp_file(file_path, session_hash=None):
+    """Registers a temp file for cleanup, optionally tied to a Gradio session."""
+    with temp_files_lock:
+        temp_files_to_clean.add(file_path)
+        if session_hash:
+            session_temp_files.setdefault(session_hash, set()).add(file_path)
+
+def remove_temp_files(file_paths):
+    """Deletes the given files, reporting any that could not be removed."""
+    for file_path in file_paths:
         try:
             os.remove(file_path)
             print(f"  - Removed: {file_path}")
@@ -26,6 +43,25 @@ def cleanup_temp_files():
             # Catch other potential errors (e.g., permissions)
             print(f"  - Error removing {file_path}: {e}")
 
+# --- Functions to perform cleanup ---
+def cleanup_temp_files():
+    """Deletes every tracked file and empties the tracking set."""
+    with temp_files_lock:
+        file_paths = list(temp_files_to_clean)
+        temp_files_to_clean.clear()
+        session_temp_files.clear()
+    print(f"Cleaning up {len(file_paths)} temporary files...")
+    remove_temp_files(file_paths)
+
+def cleanup_session_temp_files(request: gr.Request):
+    """Deletes the files created for a Gradio session when it ends."""
+    with temp_files_lock:
+        file_paths = session_temp_files.pop(request.session_hash, set())
+        temp_files_to_clean.difference_update(file_paths)
+    if file_paths:
+        print(f"Session ended, cleaning up {len(file_paths)} temporary files...")
+        remove_temp_files(file_paths)
+
 # --- Register the cleanup function to run on script exit ---
 # This will be called on normal exit and for most unhandled exceptions,
 # including KeyboardInterrupt from Ctrl+C.
@@ -37,69 +73,363 @@ api_key = os.environ.get("GEMINI_API_KEY")
 if not api_key:
     print("CRITICAL: GEMINI_API_KEY environment variable not found.")
 
+# --- Shared client (created once, reused across requests) ---
+# Reusing one client keeps the underlying HTTP session alive, so later
+# requests skip the TLS/auth setup instead of paying it on every click.
+# The SDK is imported on first use so the UI comes up without waiting on it.
+# It is loaded on a worker thread, so the lock stops concurrent first
+# requests from importing it and building clients twice.
+genai = errors = types = None
+client = None
+sdk_lock = threading.Lock()
+
+def load_gemini_sdk():
+    """Imports google.genai and creates the shared client on the first call."""
+    global genai, errors, types, client
+    if genai is not None:
+        return
+    with sdk_lock:
+        if genai is None:
+            from google import genai as genai_module
+            from google.genai import errors as errors_module, types as types_module
+            errors, types = errors_module, types_module
+            client = genai_module.Client(api_key=api_key) if api_key else None
+            genai = genai_module
+
+
+# --- Upload size cap ---
+# Longer edges than this are downscaled before upload; Gemini does not use
+# the extra resolution, it only adds bytes on the wire and token cost.
+MAX_UPLOAD_EDGE = 1568
+
+def downscale_for_upload(source_image):
+    """Caps the image's longest edge at MAX_UPLOAD_EDGE, in place."""
+    if max(source_image.size) <= MAX_UPLOAD_EDGE:
+        return source_image
+    # The image was opened from the upload just for this request, so it can
+    # be resized in place (which also lets JPEGs use PIL's fast draft mode).
+    source_image.thumbnail((MAX_UPLOAD_EDGE, MAX_UPLOAD_EDGE), Image.Resampling.LANCZOS)
+    return source_image
+
+
+# --- Lighter uploads for analysis-only prompts ---
+# Describing an image does not need lossless pixels, so such uploads are
+# sent as high-quality JPEG; edit prompts keep the original for fidelity.
+# Compiled once at import; matches whole words such as "describe",
+# "description", "analyse", "analyzing", "what", and "caption".
+ANALYSIS_PROMPT_RE = re.compile(r"\b(describ\w*|analy[sz]\w*|what|caption\w*)\b", re.IGNORECASE)
+ANALYSIS_JPEG_MIN_EDGE = 512
+ANALYSIS_JPEG_QUALITY = 85
+
+def is_analysis_prompt(prompt):
+    """Returns True if the prompt asks about the image rather than to edit it."""
+    return ANALYSIS_PROMPT_RE.search(prompt) is not None
+
+def encode_jpeg_part(source_image):
+    """Encodes the image as JPEG and wraps it as an API part, ready to upload."""
+    buffer = BytesIO()
+    source_image.convert("RGB").save(buffer, "JPEG", quality=ANALYSIS_JPEG_QUALITY, optimize=True)
+    # Passing the encoded bytes directly stops the SDK from re-encoding a PIL image.
+    return types.Part.from_bytes(data=buffer.getvalue(), mime_type="image/jpeg")
+
+
+# --- Response caches ---
+# Both map (prompt, image hash) -> ((raw image bytes, MIME type) or None, text or None).
+# Image responses hold multi-MB raw API bytes, so they get a small cache;
+# text-only answers are tiny, so many more of them can be kept around.
+# Raw API bytes are stored instead of PIL objects to keep memory bounded.
+IMAGE_CACHE_SIZE = 64
+TEXT_CACHE_SIZE = 256
+image_response_cache = OrderedDict()
+text_response_cache = OrderedDict()
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+def hash_file(file_path):
+    """Hashes a file in fixed-size chunks, without loading it all into memory."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_cache_key(prompt, source_path):
+    """Builds an exact-match cache key from the prompt and the uploaded file."""
+    # Hashing the uploaded file avoids materializing a full pixel buffer
+    # (as Image.tobytes() would) just to build a key.
+    image_hash = hash_file(source_path) if source_path else ""
+    return (prompt.strip(), image_hash)
+
+def get_cached_response(key):
+    """Looks the key up in both caches, marking a hit as recently used."""
+    for cache in (image_response_cache, text_response_cache):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    return None
+
+def cache_response(key, image, text_data):
+    """Stores a result in the matching LRU cache, evicting the oldest entry when full."""
+    if image is not None:
+        cache, max_size = image_response_cache, IMAGE_CACHE_SIZE
+    else:
+        cache, max_size = text_response_cache, TEXT_CACHE_SIZE
+    cache[key] = (image, text_data)
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+# --- Retry with exponential backoff for transient API errors ---
+MODEL_NAME = "gemini-2.5-flash-image-preview"
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 30
+# Caps in-flight API calls across all users, so batch requests do not
+# trip the rate limit on their own.
+MAX_CONCURRENT_API_CALLS = 4
+api_semaphore = asyncio.Semaphore(MAX_CONCURRENT_API_CALLS)
+
+def get_retry_after(e):
+    """Returns the server's Retry-After delay in seconds, if it sent one."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+async def generate_content_with_retry(api_contents):
+    """Calls Gemini, retrying rate-limit (429) and 5xx errors with backoff + jitter."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            async with api_semaphore:
+                return await client.aio.models.generate_content(
+                    model=MODEL_NAME,
+                    contents=api_contents,
+                )
+        except errors.APIError as e:
+            if e.code not in RETRYABLE_STATUS_CODES or attempt == MAX_ATTEMPTS - 1:
+                raise
+            # Cap server-sent Retry-After too, so a long quota wait cannot
+            # hold a queue slot for hours.
+            delay = min(get_retry_after(e) or 2 ** attempt + random.random(), MAX_BACKOFF_SECONDS)
+            print(f"Transient API Error ({e.code}), retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_ATTEMPTS})...")
+            await asyncio.sleep(delay)
+
+async def request_generation(api_contents):
+    """Makes one Gemini call and returns its ((image bytes, MIME type) or None, text or None)."""
+    response = await generate_content_with_retry(api_contents)
+
+    # Single pass over the parts, picking up the first image and text.
+    image, text_part = None, None
+    parts = response.candidates[0].content.parts if response.candidates else None
+    for part in parts or ():
+        if image is None and part.inline_data is not None:
+            image = (part.inline_data.data, part.inline_data.mime_type)
+        elif text_part is None and part.text is not None:
+            text_part = part.text
+        if image is not None and text_part is not None:
+            break
+    return image, text_part
+
+
+# --- Background worker pool for local image work ---
+# Hashing, resizing, and decoding are CPU-bound. Running them on this pool
+# keeps the event loop free to serve the UI and other users' requests.
+image_executor = ThreadPoolExecutor(max_workers=4)
+
+async def run_in_worker(func, *args):
+    """Runs a blocking function on the worker pool and awaits its result."""
+    return await asyncio.get_running_loop().run_in_executor(image_executor, func, *args)
+
+def prepare_source_image(prompt, source_path):
+    """Opens and shrinks the upload (if any) for sending to the API."""
+    source_image = None
+    if source_path:
+        # Gradio hands over the raw upload path without applying the EXIF
+        # orientation, so rotate phone photos upright before they lose the tag.
+        source_image = downscale_for_upload(ImageOps.exif_transpose(Image.open(source_path)))
+        if is_analysis_prompt(prompt) and max(source_image.size) > ANALYSIS_JPEG_MIN_EDGE:
+            source_image = encode_jpeg_part(source_image)
+    return source_image
+
+def create_temp_file(suffix, session_hash=None):
+    """Creates a tracked temp file and returns (open binary file, path)."""
+    # mkstemp creates the file with O_EXCL, so concurrent writers can never
+    # collide on a name and overwrite a file another button still serves.
+    fd, output_filepath = tempfile.mkstemp(prefix="gen_", suffix=suffix)
+
+    # --- Track the file for cleanup ---
+    track_temp_file(output_filepath, session_hash)
+    print(f"Created and tracking temp file: {output_filepath}")
+    return os.fdopen(fd, "wb"), output_filepath
+
+def image_extension(mime_type):
+    """Returns the file extension for an image MIME type, defaulting to .png."""
+    return (mime_type and mimetypes.guess_extension(mime_type)) or ".png"
+
+def build_preview_images(generated_images, session_hash=None):
+    """Writes gallery preview files and returns (preview paths, ready download path or None)."""
+    # Gradio copies a returned filepath into its cache as plain bytes, whereas
+    # a PIL image would be decoded and encoded again, so previews are files.
+    preview_filepaths = []
+    for generated_image_data, mime_type in generated_images:
+        # Previews go out as the API's own encoded bytes, with no decode at all.
+        preview_file, preview_filepath = create_temp_file(image_extension(mime_type), session_hash)
+        with preview_file:
+            preview_file.write(generated_image_data)
+        preview_filepaths.append(preview_filepath)
+
+    download_filepath = None
+    if len(generated_images) == 1:
+        # A single preview is byte-identical to the download, so serve it directly.
+        download_filepath = preview_filepaths[0]
+    return preview_filepaths, download_filepath
+
+def write_generated_images(generated_images, session_hash=None):
+    """Writes the API image bytes to a tracked temp file and returns its path."""
+    # The API already returns encoded images, so write them verbatim
+    # instead of decoding and re-encoding, named after their MIME type.
+    # A DownloadButton serves a single file, so a batch is bundled into
+    # one (uncompressed) ZIP.
+    if len(generated_images) == 1:
+        generated_image_data, mime_type = generated_images[0]
+        temp_file, output_filepath = create_temp_file(image_extension(mime_type), session_hash)
+        with temp_file:
+            temp_file.write(generated_image_data)
+    else:
+        temp_file, output_filepath = create_temp_file(".zip", session_hash)
+        with temp_file, zipfile.ZipFile(temp_file, "w", zipfile.ZIP_STORED) as archive:
+            for index, (generated_image_data, mime_type) in enumerate(generated_images, start=1):
+                archive.writestr(f"generated_image_{index}{image_extension(mime_type)}", generated_image_data)
+    return output_filepath
+
+
+# --- Reusable component updates ---
+# Built once instead of on every return. Only updates without a "value" are
+# shared, because Gradio pops "value" out of an update dict when applying it.
+HIDDEN = gr.update(visible=False)
+NO_CHANGE = gr.update()
+
+
+# --- Download on demand ---
+# Generation keeps the raw bytes in session state. A single image can be
+# downloaded straight from its preview file; a batch ZIP is only built
+# when the user actually asks for it.
+# The DownloadButton itself has no click handler, so downloading never
+# makes a server round-trip; only the separate Prepare button does.
+def prepare_download(generated_images, prepared_filepath, request: gr.Request):
+    """Builds the batch ZIP on request and reveals the download button for it."""
+    if prepared_filepath:
+        # Already built (e.g. a double click); nothing to do.
+        return NO_CHANGE, NO_CHANGE, NO_CHANGE, prepared_filepath
+    if not generated_images:
+        raise gr.Error("No generated image to download.")
+    output_filepath = write_generated_images(generated_images, request.session_hash)
+    return (
+        gr.update(visible=True, value=output_filepath),
+        HIDDEN,
+        "✅ Download ready.",
+        output_filepath
+    )
+
 
 # --- Core Logic (tracks files) ---
-def generate_image_with_gemini(prompt, source_image):
-    if not api_key:
+# Async so that several users' requests can wait on the network at the same
+# time instead of each one blocking a Gradio worker until Gemini responds.
+# A batch of `count` images is requested concurrently, so it takes about as
+# long as a single image rather than `count` times as long.
+async def generate_image_with_gemini(prompt, source_path, count, request: gr.Request):
+    # The first import is slow, so keep it off the event loop.
+    await run_in_worker(load_gemini_sdk)
+    if client is None:
         raise gr.Error("GEMINI_API_KEY not set.")
     if not prompt or not prompt.strip():
         raise gr.Error("Please enter a prompt.")
-
-    client = genai.Client(api_key=api_key)
-    api_contents = [prompt, source_image] if source_image else [prompt]
+    count = int(count)
 
     try:
-        model_name = "gemini-2.5-flash-image-preview"
-        response = client.models.generate_content(
-            model=model_name,
-            contents=api_contents,
-        )
+        # Batches ask for variations, so only single requests use the cache.
+        # The key only needs the file hash, so it is checked before any decoding.
+        cache_key = await run_in_worker(make_cache_key, prompt, source_path) if count == 1 else None
+        cached = get_cached_response(cache_key) if cache_key else None
+        failures = []
+        if cached is not None:
+            # --- Cache hit: skip decoding and the network round-trip entirely ---
+            results = [cached]
+            print("Serving response from cache.")
+        else:
+            source_image = await run_in_worker(prepare_source_image, prompt, source_path)
+            api_contents = [prompt, source_image] if source_image else [prompt]
+            outcomes = await asyncio.gather(
+                *(request_generation(api_contents) for _ in range(count)),
+                return_exceptions=True,
+            )
+            results = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+            failures = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+            if not results:
+                # Every call failed; report the first error below.
+                raise failures[0]
+            for failure in failures:
+                print(f"Caught an API Error in batch: {failure}")
+            if count == 1 and (results[0][0] is not None or results[0][1]):
+                cache_response(cache_key, *results[0])
+
+        generated_images = [image for image, _ in results if image is not None]
+        text_part = next((text for _, text in results if text), None)
+
+        if generated_images:
+            preview_filepaths, download_filepath = await run_in_worker(build_preview_images, generated_images, request.session_hash)
+            if download_filepath:
+                download_update, prepare_update = gr.update(visible=True, value=download_filepath), HIDDEN
+            else:
+                # A batch ZIP is only built if the user asks for it.
+                download_update, prepare_update = HIDDEN, gr.update(visible=True)
+            if count == 1:
+                status = "✅ Image generated successfully!"
+            else:
+                status = f"✅ Generated {len(generated_images)} of {count} images."
+                if failures:
+                    first_error = failures[0]
+                    if isinstance(first_error, errors.APIError):
+                        error_message = f"API Error ({first_error.code}): {first_error.message}"
+                    else:
+                        error_message = str(first_error)
+                    status += f" ⚠️ {len(failures)} failed, first error: {error_message}"
 
-        generated_image_data = None
-        for part in response.candidates[0].content.parts:
-            if part.inline_data is not None:
-                generated_image_data = part.inline_data.data
-                break
-        
-        if generated_image_data is not None:
-            result_image = Image.open(BytesIO(generated_image_data))
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-                output_filepath = temp_file.name
-                result_image.save(output_filepath)
-            
-            # --- Track the file for cleanup ---
-            temp_files_to_clean.append(output_filepath)
-            print(f"Created and tracking temp file: {output_filepath}")
-            
             return (
-                result_image, 
-                gr.update(visible=True, value=output_filepath), 
+                preview_filepaths, 
+                download_update, 
+                prepare_update,
                 gr.update(visible=False, value=""),
-                "✅ Image generated successfully!"
+                status,
+                generated_images,
+                download_filepath
             )
         else:
-            # (Text response logic remains the same)
-            text_response = "The model did not return an image or text."
-            if response.candidates and response.candidates[0].content.parts:
-                text_part = next((p.text for p in response.candidates[0].content.parts if p.text is not None), None)
-                if text_part:
-                    text_response = text_part
-            return (None, gr.update(visible=False), gr.update(visible=True, value=text_response), "✅ Text analysis complete.")
+            text_response = text_part or "The model did not return an image or text."
+            return (None, HIDDEN, HIDDEN, gr.update(visible=True, value=text_response), "✅ Text analysis complete.", None, None)
     
+    except UnidentifiedImageError as e:
+        # e.g. an SVG, which Gradio passes through as a filepath
+        print(f"Could not read the uploaded image: {e}")
+        return (None, HIDDEN, HIDDEN, HIDDEN, "❌ Could not read the uploaded image. Please upload a PNG, JPEG, or WebP file.", None, None)
     except errors.APIError as e:
         print(f"Caught an API Error: {e}")
         error_message_for_ui = f"❌ API Error ({e.code}): {e.message}"
         return (
-            None,                           # For output_image
-            gr.update(visible=False),       # For download_btn
-            gr.update(visible=False),       # For text_output_box
-            error_message_for_ui            # For status_box
+            None,                           # For output_gallery
+            HIDDEN,                         # For download_btn
+            HIDDEN,                         # For prepare_download_btn
+            HIDDEN,                         # For text_output_box
+            error_message_for_ui,           # For status_box
+            None,                           # For generated_image_state
+            None                            # For download_path_state
         )
     except Exception as e:
         # Catch any other unexpected errors
         print(f"An unexpected error occurred: {e}")
-        return (None, gr.update(visible=False), gr.update(visible=False), f"❌ An unexpected error occurred: {e}")
+        return (None, HIDDEN, HIDDEN, HIDDEN, f"❌ An unexpected error occurred: {e}", None, None)
     
 # --- Gradio User Interface ---
 with gr.Blocks(title="🎨 Gemini Image & Text Generator") as demo:
@@ -107,23 +437,35 @@ with gr.Blocks(title="🎨 Gemini Image & Text Generator") as demo:
     gr.Markdown("Provide a prompt to generate a new image (text-to-image), OR upload an image to edit/analyze it.")
     with gr.Row():
         with gr.Column(scale=1):
-            input_image = gr.Image(type="pil", label="Upload an Image (Optional)", height=400)
+            input_image = gr.Image(type="filepath", label="Upload an Image (Optional)", height=400)
             prompt_box = gr.Textbox(label="Your Prompt", placeholder="Text-to-Image: A photo of a cat programming on a laptop...", lines=5)
             with gr.Row():
                 clear_btn = gr.Button(value="🗑️ Clear Prompt", scale=1)
                 generate_btn = gr.Button("Generate", variant="primary", scale=2)
+            count_slider = gr.Slider(1, 8, value=1, step=1, label="Images")
             status_box = gr.Markdown("")
         with gr.Column(scale=1):
             # NEW (Gradio 6.0)
-            output_image = gr.Image(label="Generated Image", height=400, buttons = [])
+            output_gallery = gr.Gallery(label="Generated Images", height=400, buttons = [])
             text_output_box = gr.Textbox(label="Model's Text Response", visible=False, lines=15, interactive=False)
+            prepare_download_btn = gr.Button("Prepare Download", visible=False)
             download_btn = gr.DownloadButton(label="Download Image", visible=False)
+    # Raw bytes of the last generated images, per session
+    generated_image_state = gr.State(None)
+    # Path of the file the download button currently serves, per session
+    download_path_state = gr.State(None)
 
-    generate_btn.click(fn=generate_image_with_gemini, inputs=[prompt_box, input_image], outputs=[output_image, download_btn, text_output_box, status_box])
+    generate_btn.click(fn=generate_image_with_gemini, inputs=[prompt_box, input_image, count_slider], outputs=[output_gallery, download_btn, prepare_download_btn, text_output_box, status_box, generated_image_state, download_path_state])
+    prepare_download_btn.click(fn=prepare_download, inputs=[generated_image_state, download_path_state], outputs=[download_btn, prepare_download_btn, status_box, download_path_state])
+    # --- Remove a session's files as soon as its browser tab closes ---
+    demo.unload(cleanup_session_temp_files)
     clear_btn.click(fn=lambda: ("", "Prompt cleared."), inputs=None, outputs=[prompt_box, status_box], queue=False)
+
+# --- Allow several generations to be awaited concurrently ---
+demo.queue(default_concurrency_limit=8)
     
 if __name__ == "__main__":
     print("Launching Gradio interface... Press Ctrl+C to exit.")
-    print("Temporary files for this session will be cleaned up automatically on exit.")
+    print("Temporary files are cleaned up when each browser session ends, and on exit.")
     # NEW (Gradio 6.0)
     demo.launch(theme=gr.themes.Soft())